@@ -29,54 +29,117 @@ export function AudioProvider({ children }) {
   } = useAudioAnalysis()
 
   const pollIntervalRef = useRef(null)
+  const statusSourceRef = useRef(null)
+  const statusEtagRef = useRef(null)
 
   /**
-   * Poll for job status
+   * Stop listening for job status updates
+   */
+  const stopStatusUpdates = useCallback(() => {
+    if (statusSourceRef.current) {
+      statusSourceRef.current.close()
+      statusSourceRef.current = null
+    }
+    if (pollIntervalRef.current) {
+      clearInterval(pollIntervalRef.current)
+      pollIntervalRef.current = null
+    }
+  }, [])
+
+  /**
+   * Handle a job status update from the stream or a poll
+   */
+  const handleJobStatus = useCallback(async (data) => {
+    if (data.status === 'completed' && data.stems) {
+      // Stop status updates
+      stopStatusUpdates()
+      
+      setProcessingStatus({ stage: 'downloading', progress: 0.8 })
+      
+      // Load the separated stems
+      await loadStems(data.stems)
+      
+      setProcessingStatus({ stage: 'loading', progress: 0.95 })
+      
+      // Start analysis loop
+      startAnalysisLoop(setAnalysisData)
+      
+      setIsProcessing(false)
+      setProcessingStatus(null)
+      setIsReady(true)
+      
+    } else if (data.status === 'failed') {
+      stopStatusUpdates()
+      setProcessingStatus({ 
+        stage: 'error', 
+        progress: 0, 
+        message: data.error || 'Processing failed' 
+      })
+      setIsProcessing(false)
+      
+    } else {
+      // Still processing
+      setProcessingStatus({ 
+        stage: 'processing', 
+        progress: data.progress || 0.3,
+        message: 'Separating stems with Demucs...' 
+      })
+    }
+  }, [loadStems, startAnalysisLoop, stopStatusUpdates])
+
+  /**
+   * Poll for job status (fallback when the status stream is unavailable)
    */
   const pollJobStatus = useCallback(async (jobId) => {
     try {
-      const response = await fetch(`/api/status/${jobId}`)
-      const data = await response.json()
+      const response = await fetch(`/api/status/${jobId}`, {
+        cache: 'no-store',
+        headers: statusEtagRef.current ? { 'If-None-Match': statusEtagRef.current } : {},
+      })
       
-      if (data.status === 'completed' && data.stems) {
-        // Clear polling
-        clearInterval(pollIntervalRef.current)
-        
-        setProcessingStatus({ stage: 'downloading', progress: 0.8 })
-        
-        // Load the separated stems
-        await loadStems(data.stems)
-        
-        setProcessingStatus({ stage: 'loading', progress: 0.95 })
-        
-        // Start analysis loop
-        startAnalysisLoop(setAnalysisData)
-        
-        setIsProcessing(false)
-        setProcessingStatus(null)
-        setIsReady(true)
-        
-      } else if (data.status === 'failed') {
-        clearInterval(pollIntervalRef.current)
-        setProcessingStatus({ 
-          stage: 'error', 
-          progress: 0, 
-          message: data.error || 'Processing failed' 
-        })
-        setIsProcessing(false)
-        
-      } else {
-        // Still processing
-        setProcessingStatus({ 
-          stage: 'processing', 
-          progress: data.progress || 0.3,
-          message: 'Separating stems with Demucs...' 
-        })
-      }
+      // Status unchanged since the last poll
+      if (response.status === 304) return
+      
+      statusEtagRef.current = response.headers.get('ETag')
+      const data = await response.json()
+      await handleJobStatus(data)
     } catch (error) {
       console.error('Failed to poll status:', error)
     }
-  }, [loadStems, startAnalysisLoop])
+  }, [handleJobStatus])
+
+  /**
+   * Listen for job status updates pushed by the server,
+   * falling back to polling if the stream drops
+   */
+  const watchJobStatus = useCallback((jobId) => {
+    stopStatusUpdates()
+    
+    const startPolling = () => {
+      pollIntervalRef.current = setInterval(() => {
+        pollJobStatus(jobId)
+      }, 2000)
+    }
+    
+    if (!window.EventSource) {
+      startPolling()
+      return
+    }
+    
+    const source = new EventSource(`/api/status-stream/${jobId}`)
+    source.onmessage = (event) => {
+      handleJobStatus(JSON.parse(event.data))
+    }
+    source.onerror = () => {
+      // Stream ended before a final status; keep going by polling
+      source.close()
+      if (statusSourceRef.current === source) {
+        statusSourceRef.current = null
+        startPolling()
+      }
+    }
+    statusSourceRef.current = source
+  }, [handleJobStatus, pollJobStatus, stopStatusUpdates])
 
   /**
    * Upload an audio file for processing
@@ -102,10 +165,8 @@ export function AudioProvider({ children }) {
       
       setProcessingStatus({ stage: 'processing', progress: 0.2 })
       
-      // Start polling for completion
-      pollIntervalRef.current = setInterval(() => {
-        pollJobStatus(data.job_id)
-      }, 2000)
+      // Listen for completion
+      watchJobStatus(data.job_id)
       
     } catch (error) {
       console.error('Upload error:', error)
@@ -116,7 +177,7 @@ export function AudioProvider({ children }) {
       })
       setIsProcessing(false)
     }
-  }, [pollJobStatus])
+  }, [watchJobStatus])
 
   /**
    * Load audio from a URL (SoundCloud, direct audio links, etc.)
@@ -144,10 +205,8 @@ export function AudioProvider({ children }) {
       
       setProcessingStatus({ stage: 'processing', progress: 0.2, message: 'Processing audio...' })
       
-      // Start polling for completion
-      pollIntervalRef.current = setInterval(() => {
-        pollJobStatus(data.job_id)
-      }, 2000)
+      // Listen for completion
+      watchJobStatus(data.job_id)
       
     } catch (error) {
       console.error('URL processing error:', error)
@@ -160,7 +219,7 @@ export function AudioProvider({ children }) {
         setIsProcessing(false)
       }, 3000)
     }
-  }, [pollJobStatus])
+  }, [watchJobStatus])
 
   /**
    * Start microphone capture for live visualization
@@ -215,10 +274,8 @@ export function AudioProvider({ children }) {
    * Reset everything
    */
   const reset = useCallback(() => {
-    // Clear polling
-    if (pollIntervalRef.current) {
-      clearInterval(pollIntervalRef.current)
-    }
+    // Stop status updates
+    stopStatusUpdates()
     
     // Clean up audio
     cleanupAudio()
@@ -231,16 +288,14 @@ export function AudioProvider({ children }) {
     setIsMicActive(false)
     setMutedStems([])
     setAnalysisData({})
-  }, [cleanupAudio])
+  }, [cleanupAudio, stopStatusUpdates])
 
   // Cleanup on unmount
   useEffect(() => {
     return () => {
-      if (pollIntervalRef.current) {
-        clearInterval(pollIntervalRef.current)
-      }
+      stopStatusUpdates()
     }
-  }, [])
+  }, [stopStatusUpdates])
 
   const value = {
     // State
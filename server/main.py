@@ -4,8 +4,13 @@ FastAPI server for audio stem separation using Demucs
 """
 
 import os
+from contextlib import asynccontextmanager
+
+import aiohttp
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 
@@ -13,10 +18,105 @@ from routes import separation
 
 load_dotenv()
 
+
+class ApiGZipMiddleware(GZipMiddleware):
+    """
+    GZip JSON API responses only; stems are already-encoded binary audio
+    and event streams must not be buffered by the compressor.
+    """
+    
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if (
+            scope["type"] == "http"
+            and path.startswith("/api/")
+            and not path.startswith("/api/status-stream/")
+        ):
+            await super().__call__(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject oversized /api/separate uploads from their Content-Length before
+    FastAPI parses (and spools to disk) the multipart body. The upload
+    route's streaming byte count remains as a backstop.
+    """
+    
+    # Allowance for multipart boundaries and part headers around the file
+    MULTIPART_OVERHEAD = 64 * 1024
+    
+    def __init__(self, app, path: str, max_bytes: int):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == self.path and scope["method"] == "POST":
+            headers = dict(scope["headers"])
+            content_length = headers.get(b"content-length")
+            if content_length is None:
+                response = JSONResponse({"detail": "Content-Length required"}, status_code=411)
+                await response(scope, receive, send)
+                return
+            try:
+                too_large = int(content_length) > self.max_bytes + self.MULTIPART_OVERHEAD
+            except ValueError:
+                too_large = True
+            if too_large:
+                response = JSONResponse({"detail": "File too large"}, status_code=413)
+                await response(scope, receive, send)
+                return
+        
+        await self.app(scope, receive, send)
+
+
+class StemFiles(StaticFiles):
+    """Static stem files. A job's stems never change, so they are cached as immutable."""
+    
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create working directories once instead of on every request
+    for directory in (separation.UPLOAD_DIR, separation.URL_CACHE_DIR):
+        os.makedirs(directory, exist_ok=True)
+    
+    # Shared HTTP session so downloads reuse pooled keep-alive connections
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=10,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+        )
+    )
+    await separation.demucs_service.start()
+    try:
+        yield
+    finally:
+        await separation.demucs_service.stop()
+        await app.state.http.close()
+
+
 app = FastAPI(
     title="Music Visualizer API",
     description="Audio stem separation API using Demucs",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+)
+
+# Reject oversized uploads before the body is read
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    path="/api/separate",
+    max_bytes=separation.MAX_UPLOAD_BYTES,
 )
 
 # CORS configuration for local development
@@ -28,12 +128,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress JSON API responses such as repeated status polls
+app.add_middleware(ApiGZipMiddleware, minimum_size=256)
+
 # Create output directory for separated stems
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # Serve separated audio files statically
-app.mount("/stems", StaticFiles(directory=OUTPUT_DIR), name="stems")
+app.mount("/stems", StemFiles(directory=OUTPUT_DIR), name="stems")
 
 # Register routes
 app.include_router(separation.router, prefix="/api", tags=["separation"])
@@ -47,6 +150,7 @@ async def root():
         "endpoints": {
             "separate": "POST /api/separate",
             "status": "GET /api/status/{job_id}",
+            "status_stream": "GET /api/status-stream/{job_id}",
             "stems": "GET /stems/{job_id}/{stem}.wav"
         }
     }
@@ -4,19 +4,42 @@ Handles file upload, URL download, and Demucs processing
 """
 
 import os
+import json
 import uuid
+import hashlib
+import aiofiles
 import aiohttp
 import asyncio
 from typing import Optional
 from urllib.parse import urlparse
-from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks
+from fastapi import APIRouter, UploadFile, File, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from services.demucs_service import DemucsService, JobStatus
+from services.demucs_service import DemucsService, JobStatus, evict_lru, link_or_copy
 
 router = APIRouter()
 demucs_service = DemucsService()
 
+# Network read size and on-disk write buffer for streamed audio
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+WRITE_BUFFER_SIZE = 1 << 20
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=300)
+
+# Largest upload or download accepted, checked up front and while streaming
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 100 * 1024 * 1024))
+
+# Seconds between keepalive comments on an idle status stream
+SSE_KEEPALIVE = 15
+
+# Created once at startup by the app lifespan
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
+
+# Downloaded audio keyed by URL, revalidated with ETag/Last-Modified and
+# evicted least-recently-used beyond URL_CACHE_MAX_GB
+URL_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "url")
+URL_CACHE_MAX_BYTES = int(float(os.getenv("URL_CACHE_MAX_GB", "5")) * 1024 ** 3)
+
 
 class SeparationResponse(BaseModel):
     job_id: str
@@ -36,29 +59,116 @@ class StatusResponse(BaseModel):
     error: Optional[str] = None
 
 
-async def download_audio_from_url(url: str, output_path: str) -> bool:
-    """Download audio from a URL to a local file."""
+async def save_response_body(response: aiohttp.ClientResponse, path: str) -> None:
+    """Stream a response body to path, aborting once it passes MAX_UPLOAD_BYTES."""
+    total = 0
+    async with aiofiles.open(path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            total += len(chunk)
+            if total > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="File too large")
+            await f.write(chunk)
+
+
+async def download_audio_from_url(
+    session: aiohttp.ClientSession, url: str, output_path: str
+) -> bool:
+    """
+    Download audio from a URL to a local file using the shared session.
+    Responses with validators are cached per URL so repeat downloads
+    only cost a conditional request and a 304.
+    Raises HTTPException(413) if the audio is larger than MAX_UPLOAD_BYTES.
+    """
+    entry_dir = os.path.join(URL_CACHE_DIR, hashlib.sha1(url.encode()).hexdigest())
+    cached_path = os.path.join(entry_dir, "audio")
+    meta_path = os.path.join(entry_dir, ".meta")
+    
+    tmp_path = os.path.join(entry_dir, f"audio.{uuid.uuid4().hex}.part")
+    tmp_meta_path = os.path.join(entry_dir, f".meta.{uuid.uuid4().hex}.part")
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=300)) as response:
-                if response.status != 200:
-                    return False
-                
-                with open(output_path, 'wb') as f:
-                    while True:
-                        chunk = await response.content.read(8192)
-                        if not chunk:
-                            break
-                        f.write(chunk)
-        return True
+        # An unreadable or missing entry is treated as a cache miss
+        headers = {}
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if os.path.exists(cached_path):
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+        except (OSError, ValueError, AttributeError):
+            headers = {}
+        
+        async with session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status == 304 and headers:
+                link_or_copy(cached_path, output_path)
+                # Record use for LRU eviction
+                try:
+                    os.utime(entry_dir)
+                except OSError:
+                    pass
+                return True
+            
+            if response.status != 200:
+                return False
+            
+            if (response.content_length or 0) > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="File too large")
+            
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if not etag and not last_modified:
+                # Nothing to revalidate against, so don't cache
+                await save_response_body(response, output_path)
+                return True
+            
+            os.makedirs(entry_dir, exist_ok=True)
+            await save_response_body(response, tmp_path)
+        
+        # Replace audio and meta atomically so readers never see partial files
+        os.replace(tmp_path, cached_path)
+        with open(tmp_meta_path, "w") as f:
+            json.dump({"etag": etag, "last_modified": last_modified}, f)
+        os.replace(tmp_meta_path, meta_path)
+        link_or_copy(cached_path, output_path)
     except Exception as e:
+        for path in (tmp_path, tmp_meta_path, output_path):
+            if os.path.exists(path):
+                os.remove(path)
+        if isinstance(e, HTTPException):
+            raise
         print(f"Download error: {e}")
         return False
+    
+    # Eviction is best-effort; the download itself has succeeded
+    try:
+        evict_lru(URL_CACHE_DIR, URL_CACHE_MAX_BYTES)
+    except OSError as e:
+        print(f"URL cache error: {e}")
+    return True
+
+
+def build_status_response(job_id: str, job: JobStatus) -> StatusResponse:
+    """Build the API status for a job, with stem URLs once complete."""
+    response = StatusResponse(
+        job_id=job_id,
+        status=job.status,
+        progress=job.progress,
+        error=job.error
+    )
+    
+    if job.status == "completed" and job.stems:
+        # Return URLs for each stem
+        response.stems = {
+            stem: f"/stems/{job_id}/{stem}.wav"
+            for stem in job.stems
+        }
+    
+    return response
 
 
 @router.post("/separate", response_model=SeparationResponse)
 async def separate_audio(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
 ):
     """
@@ -73,25 +183,40 @@ async def separate_audio(
             detail=f"Invalid file type: {file.content_type}. Allowed: {allowed_types}"
         )
     
+    # Content-Length is already checked by UploadSizeLimitMiddleware before
+    # the body is parsed; this and the byte count below are backstops
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+    
     # Generate job ID
     job_id = str(uuid.uuid4())
     
     # Save uploaded file
-    upload_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
-    os.makedirs(upload_dir, exist_ok=True)
-    
     file_ext = os.path.splitext(file.filename)[1] or ".mp3"
-    input_path = os.path.join(upload_dir, f"{job_id}{file_ext}")
+    input_path = os.path.join(UPLOAD_DIR, f"{job_id}{file_ext}")
     
     try:
-        contents = await file.read()
-        with open(input_path, "wb") as f:
-            f.write(contents)
+        total = 0
+        async with aiofiles.open(input_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            while chunk := await file.read(WRITE_BUFFER_SIZE):
+                total += len(chunk)
+                if total > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                await f.write(chunk)
     except Exception as e:
+        if os.path.exists(input_path):
+            os.remove(input_path)
+        if isinstance(e, HTTPException):
+            raise
         raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
     
-    # Start separation in background
-    background_tasks.add_task(demucs_service.separate, job_id, input_path)
+    # Queue separation, rejecting the job if the queue is full
+    if not await demucs_service.enqueue(job_id, input_path):
+        os.remove(input_path)
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy. Please try again later."
+        )
     
     return SeparationResponse(
         job_id=job_id,
@@ -102,8 +227,8 @@ async def separate_audio(
 
 @router.post("/separate-url", response_model=SeparationResponse)
 async def separate_from_url(
-    background_tasks: BackgroundTasks,
     request: UrlRequest,
+    http_request: Request,
 ):
     """
     Download audio from URL and process for stem separation.
@@ -133,19 +258,21 @@ async def separate_from_url(
     else:
         file_ext = '.mp3'
     
-    # Create upload directory
-    upload_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
-    os.makedirs(upload_dir, exist_ok=True)
-    input_path = os.path.join(upload_dir, f"{job_id}{file_ext}")
+    input_path = os.path.join(UPLOAD_DIR, f"{job_id}{file_ext}")
     
     # Set initial status
-    demucs_service.jobs[job_id] = JobStatus(status="downloading", progress=0.05)
+    demucs_service.set_status(job_id, status="downloading", progress=0.05)
     
     # Download the file
-    success = await download_audio_from_url(url, input_path)
+    try:
+        success = await download_audio_from_url(http_request.app.state.http, url, input_path)
+    except HTTPException as e:
+        demucs_service.set_status(job_id, status="failed", error=e.detail)
+        raise
     
     if not success or not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
-        demucs_service.jobs[job_id] = JobStatus(
+        demucs_service.set_status(
+            job_id,
             status="failed",
             error="Failed to download audio from URL. Make sure it's a direct audio link."
         )
@@ -154,8 +281,18 @@ async def separate_from_url(
             detail="Failed to download audio. Please provide a direct link to an audio file (MP3, WAV, FLAC)."
         )
     
-    # Start separation in background
-    background_tasks.add_task(demucs_service.separate, job_id, input_path)
+    # Queue separation, rejecting the job if the queue is full
+    if not await demucs_service.enqueue(job_id, input_path):
+        os.remove(input_path)
+        demucs_service.set_status(
+            job_id,
+            status="failed",
+            error="Server is busy. Please try again later."
+        )
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy. Please try again later."
+        )
     
     return SeparationResponse(
         job_id=job_id,
@@ -165,31 +302,51 @@ async def separate_from_url(
 
 
 @router.get("/status/{job_id}", response_model=StatusResponse)
-async def get_status(job_id: str):
+async def get_status(job_id: str, http_request: Request, http_response: Response):
     """
     Get the status of a separation job.
-    Returns stem URLs when complete.
+    Returns stem URLs when complete, or 304 if the status is unchanged
+    since the client's If-None-Match ETag.
     """
     job = demucs_service.get_job_status(job_id)
     
     if job is None:
         raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
     
-    response = StatusResponse(
-        job_id=job_id,
-        status=job.status,
-        progress=job.progress,
-        error=job.error
-    )
+    etag = '"' + hashlib.md5(
+        f"{job_id}|{job.status}|{job.progress}|{job.error}|{job.stems}".encode()
+    ).hexdigest() + '"'
+    if http_request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    http_response.headers["ETag"] = etag
     
-    if job.status == "completed" and job.stems:
-        # Return URLs for each stem
-        response.stems = {
-            stem: f"/stems/{job_id}/{stem}.wav"
-            for stem in job.stems
-        }
+    return build_status_response(job_id, job)
+
+
+@router.get("/status-stream/{job_id}")
+async def stream_status(job_id: str):
+    """
+    Stream status updates for a separation job as Server-Sent Events.
+    An event is pushed only when the job changes; the stream closes
+    once the job completes, fails or is cancelled.
+    """
+    if demucs_service.get_job_status(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
     
-    return response
+    async def events():
+        async for job in demucs_service.watch_job(job_id, keepalive=SSE_KEEPALIVE):
+            if job is None:
+                # Comment line keeps idle-timeout proxies from closing the stream
+                yield ": ping\n\n"
+                continue
+            status = build_status_response(job_id, job)
+            yield f"data: {status.model_dump_json()}\n\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @router.delete("/job/{job_id}")
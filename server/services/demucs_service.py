@@ -4,12 +4,23 @@ Handles audio stem separation using the Demucs model
 """
 
 import os
+import uuid
+import asyncio
+import hashlib
+import mmap
 import shutil
-import subprocess
-from dataclasses import dataclass, field
-from typing import Dict, List, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import AsyncIterator, Dict, List, Optional
 from enum import Enum
 
+import torch
+from cachetools import TTLCache
+from demucs.apply import BagOfModels, apply_model
+from demucs.audio import AudioFile, save_audio
+from demucs.pretrained import get_model
+
 
 class JobStatusEnum(str, Enum):
     PENDING = "pending"
@@ -27,6 +38,117 @@ class JobStatus:
     error: Optional[str] = None
 
 
+def available_cpus() -> int:
+    """CPUs this process may run on, honouring affinity/cgroup cpusets."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """Hardlink src to dst, falling back to a copy across filesystems."""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def evict_lru(cache_dir: str, max_size_bytes: int) -> None:
+    """
+    Remove the least-recently-used entry directories under cache_dir (by
+    mtime) until their total size is at most max_size_bytes. Entries that
+    disappear mid-scan, e.g. evicted by another worker, are skipped.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if name.startswith("."):
+            continue
+        try:
+            if not os.path.isdir(entry_dir):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry_dir, f))
+                for f in os.listdir(entry_dir)
+            )
+            mtime = os.path.getmtime(entry_dir)
+        except OSError:
+            continue
+        entries.append((mtime, size, entry_dir))
+        total += size
+    
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_size_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+
+
+class StemCache:
+    """
+    Cache for separated stems to avoid re-processing the same audio.
+    Stems are keyed by the SHA-256 hash of the source audio file (plus
+    the separation settings) and evicted least-recently-used once the
+    cache exceeds max_size_gb.
+    """
+    
+    def __init__(self, cache_dir: str, stems: List[str], max_size_gb: float = 10.0):
+        self.cache_dir = cache_dir
+        self.stems = stems
+        self.max_size_bytes = int(max_size_gb * 1024 ** 3)
+        os.makedirs(self.cache_dir, exist_ok=True)
+    
+    def hash_file(self, path: str) -> str:
+        """Return the SHA-256 hex digest of a file."""
+        with open(path, "rb") as f:
+            if hasattr(hashlib, "file_digest"):
+                return hashlib.file_digest(f, "sha256").hexdigest()
+            
+            # Python < 3.11: hash the whole mapped file in one update call
+            h = hashlib.sha256()
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    h.update(memoryview(mm))
+            return h.hexdigest()
+    
+    def get(self, cache_key: str) -> Optional[Dict[str, str]]:
+        """Return {stem: path} for a cached entry, or None on a miss."""
+        entry_dir = os.path.join(self.cache_dir, cache_key)
+        paths = {stem: os.path.join(entry_dir, f"{stem}.wav") for stem in self.stems}
+        if not all(os.path.exists(p) for p in paths.values()):
+            return None
+        
+        # Record access time for LRU eviction
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            pass
+        return paths
+    
+    def put(self, cache_key: str, stem_paths: Dict[str, str]) -> None:
+        """Store separated stems under the given key and evict if over budget."""
+        entry_dir = os.path.join(self.cache_dir, cache_key)
+        if os.path.exists(entry_dir):
+            return
+        
+        # Populate a temp dir first so readers never see a partial entry
+        tmp_dir = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            for stem, src in stem_paths.items():
+                link_or_copy(src, os.path.join(tmp_dir, f"{stem}.wav"))
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another job cached the same audio first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        
+        evict_lru(self.cache_dir, self.max_size_bytes)
+
+
 class DemucsService:
     """
     Service for separating audio into stems using Demucs.
@@ -39,128 +161,408 @@ class DemucsService:
     # Output stems from the model
     STEMS = ["drums", "bass", "vocals", "other"]
     
+    # Maximum number of jobs waiting for a worker before new jobs are rejected
+    QUEUE_SIZE = 32
+    
+    # Finished job records are dropped after JOB_TTL seconds so the table
+    # stays bounded; queued and running jobs never expire
+    MAX_JOBS = 10_000
+    JOB_TTL = 3600
+    
+    FINAL_STATUSES = (
+        JobStatusEnum.COMPLETED,
+        JobStatusEnum.FAILED,
+        JobStatusEnum.CANCELLED
+    )
+    
     def __init__(self):
-        self.jobs: Dict[str, JobStatus] = {}
+        # Written from worker threads and read from the event loop; all
+        # access goes through set_status/update_job/get_job_status
+        self.jobs: TTLCache = TTLCache(maxsize=self.MAX_JOBS, ttl=self.JOB_TTL)
+        self._active_jobs: Dict[str, JobStatus] = {}
+        self._jobs_lock = threading.Lock()
+        
+        # Per-job events set on the event loop whenever a job changes
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._job_events: Dict[str, asyncio.Event] = {}
+        
+        # Stems are independent files, so they are encoded and written in parallel;
+        # save_audio writes by path so any torchaudio backend (including SoX) works
+        self._write_pool = ThreadPoolExecutor(max_workers=len(self.STEMS))
+        
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
         self.output_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "output")
         os.makedirs(self.output_dir, exist_ok=True)
+        self.cache = StemCache(
+            cache_dir=os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "stems"),
+            stems=self.STEMS,
+            max_size_gb=float(os.getenv("STEM_CACHE_MAX_GB", "10")),
+        )
+        
+        # Load the model once so every job skips interpreter and weight loading
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = get_model(self.MODEL)
+        self.model.to(self.device)
+        self.model.eval()
+        
+        # Shorter segments lower peak memory at some cost in speed. Like the
+        # demucs CLI, reject segments longer than the model was trained on.
+        segment = os.getenv("DEMUCS_SEGMENT")
+        self.segment: Optional[float] = float(segment) if segment else None
+        if self.segment is not None:
+            if isinstance(self.model, BagOfModels):
+                max_segment = float(self.model.max_allowed_segment)
+            else:
+                max_segment = float(getattr(self.model, "segment", float("inf")))
+            if self.segment > max_segment:
+                raise ValueError(
+                    f"DEMUCS_SEGMENT={self.segment} exceeds the maximum of "
+                    f"{max_segment} seconds for {self.MODEL}"
+                )
+        
+        # One worker on GPU keeps a single model in VRAM; scale with cores on
+        # CPU and split the cores between workers so OpenMP isn't oversubscribed
+        cpus = available_cpus()
+        if self.device == "cuda":
+            self.num_workers = 1
+        else:
+            self.num_workers = max(1, cpus // 4)
+            torch.set_num_threads(max(1, cpus // self.num_workers))
+        
+        # Half precision on GPU halves activation bandwidth; CPU stays FP32.
+        # DEMUCS_HALF_PRECISION: "1" (default) for float16, "bf16" to opt in
+        # to bfloat16, "0" for full FP32. Non-finite half-precision output
+        # is detected per job and redone in FP32 (see _run_model).
+        self.autocast_dtype: Optional[torch.dtype] = None
+        half_precision = os.getenv("DEMUCS_HALF_PRECISION", "1")
+        if self.device == "cuda":
+            if half_precision == "bf16" and torch.cuda.is_bf16_supported():
+                self.autocast_dtype = torch.bfloat16
+            elif half_precision != "0":
+                self.autocast_dtype = torch.float16
+    
+    async def start(self) -> None:
+        """Create the job queue and start the separation workers."""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.num_workers)
+        ]
+    
+    async def stop(self) -> None:
+        """Cancel the separation workers."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+    
+    async def _worker(self) -> None:
+        while True:
+            job_id, input_path, cache_key = await self._queue.get()
+            try:
+                await asyncio.to_thread(self.separate, job_id, input_path, cache_key)
+            finally:
+                self._queue.task_done()
+    
+    async def enqueue(self, job_id: str, input_path: str) -> bool:
+        """
+        Complete a job straight from the stem cache, or queue it for
+        separation on a miss. Returns False if the queue is full and the
+        job was not accepted.
+        """
+        # Check the cache before queueing so repeat audio never waits
+        # behind other separations or takes a queue slot
+        cache_key = await asyncio.to_thread(self._cache_lookup_key, input_path)
+        if cache_key is not None and await asyncio.to_thread(
+            self._serve_from_cache, job_id, input_path, cache_key
+        ):
+            return True
+        
+        try:
+            self._queue.put_nowait((job_id, input_path, cache_key))
+        except asyncio.QueueFull:
+            return False
+        
+        self.set_status(job_id, status=JobStatusEnum.PENDING)
+        return True
     
     def get_job_status(self, job_id: str) -> Optional[JobStatus]:
-        """Get the status of a job by ID."""
-        return self.jobs.get(job_id)
+        """Get a snapshot of the status of a job by ID."""
+        with self._jobs_lock:
+            job = self._lookup(job_id)
+            return replace(job) if job is not None else None
+    
+    def set_status(self, job_id: str, **fields) -> None:
+        """Replace the status record of a job."""
+        with self._jobs_lock:
+            self._store(job_id, JobStatus(**fields))
+        self._notify(job_id)
+    
+    def update_job(self, job_id: str, **fields) -> bool:
+        """Update fields on an existing job. Returns False if the job is unknown."""
+        with self._jobs_lock:
+            job = self._lookup(job_id)
+            if job is None:
+                return False
+            self._store(job_id, replace(job, **fields))
+        self._notify(job_id)
+        return True
+    
+    def _lookup(self, job_id: str) -> Optional[JobStatus]:
+        job = self._active_jobs.get(job_id)
+        return job if job is not None else self.jobs.get(job_id)
+    
+    def _store(self, job_id: str, job: JobStatus) -> None:
+        # Only finished jobs go into the TTL cache
+        if job.status in self.FINAL_STATUSES:
+            self._active_jobs.pop(job_id, None)
+            self.jobs[job_id] = job
+        else:
+            self.jobs.pop(job_id, None)
+            self._active_jobs[job_id] = job
     
-    def separate(self, job_id: str, input_path: str) -> None:
+    def _notify(self, job_id: str) -> None:
+        """Wake status watchers. Safe to call from worker threads."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake_watchers, job_id)
+    
+    def _wake_watchers(self, job_id: str) -> None:
+        event = self._job_events.pop(job_id, None)
+        if event is not None:
+            event.set()
+    
+    async def watch_job(
+        self, job_id: str, keepalive: Optional[float] = None
+    ) -> AsyncIterator[Optional[JobStatus]]:
+        """
+        Yield a job's status now and after every change, stopping once
+        the job finishes or is no longer tracked. If keepalive is set,
+        None is yielded whenever that many seconds pass without a change.
+        """
+        while True:
+            # Take the event before reading so no change can be missed
+            event = self._job_events.setdefault(job_id, asyncio.Event())
+            job = self.get_job_status(job_id)
+            if job is None or job.status in self.FINAL_STATUSES:
+                # No further notifications will pop this job's event.
+                # Watchers that merely disconnect leave it for the next
+                # notify, since other watchers may still be waiting on it.
+                if self._job_events.get(job_id) is event:
+                    del self._job_events[job_id]
+            if job is None:
+                return
+            
+            yield job
+            
+            if job.status in self.FINAL_STATUSES:
+                return
+            
+            while True:
+                try:
+                    await asyncio.wait_for(event.wait(), keepalive)
+                    break
+                except asyncio.TimeoutError:
+                    yield None
+    
+    def separate(self, job_id: str, input_path: str, cache_key: Optional[str] = None) -> None:
         """
         Run Demucs separation on the input file.
-        This is meant to be run as a background task.
+        This is blocking and is run in a worker thread by the job queue.
         """
-        self.jobs[job_id] = JobStatus(status=JobStatusEnum.PROCESSING, progress=0.1)
+        # Skip jobs cancelled while queued (their record may since have expired)
+        job = self.get_job_status(job_id)
+        if job is None or job.status == JobStatusEnum.CANCELLED:
+            if os.path.exists(input_path):
+                os.remove(input_path)
+            return
+        
+        self.set_status(job_id, status=JobStatusEnum.PROCESSING, progress=0.1)
         
         job_output_dir = os.path.join(self.output_dir, job_id)
         os.makedirs(job_output_dir, exist_ok=True)
         
         try:
-            # Run demucs command
-            # Using subprocess to run demucs CLI for simplicity
-            cmd = [
-                "python", "-m", "demucs",
-                "-n", self.MODEL,
-                "--two-stems=None",  # Get all 4 stems
-                "-o", job_output_dir,
-                input_path
-            ]
-            
-            self.jobs[job_id].progress = 0.2
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=600  # 10 minute timeout
-            )
-            
-            if result.returncode != 0:
-                raise Exception(f"Demucs failed: {result.stderr}")
+            # Check again: an earlier queued job may have cached this audio
+            if cache_key is None:
+                cache_key = self._cache_lookup_key(input_path)
+            if cache_key is not None and self._serve_from_cache(job_id, input_path, cache_key):
+                return
             
-            self.jobs[job_id].progress = 0.9
+            self.update_job(job_id, progress=0.2)
             
-            # Demucs outputs to: output_dir/htdemucs_ft/filename/stem.wav
-            # We need to move files to: output_dir/job_id/stem.wav
-            input_filename = os.path.splitext(os.path.basename(input_path))[0]
-            demucs_output = os.path.join(job_output_dir, self.MODEL, input_filename)
+            stems_found = self._run_model(job_id, input_path, job_output_dir)
             
-            stems_found = []
-            for stem in self.STEMS:
-                src = os.path.join(demucs_output, f"{stem}.wav")
-                dst = os.path.join(job_output_dir, f"{stem}.wav")
-                if os.path.exists(src):
-                    shutil.move(src, dst)
-                    stems_found.append(stem)
+            self.update_job(job_id, progress=0.9)
             
-            # Clean up demucs subdirectories
-            demucs_subdir = os.path.join(job_output_dir, self.MODEL)
-            if os.path.exists(demucs_subdir):
-                shutil.rmtree(demucs_subdir)
+            # Caching is best-effort; the job's stems are already written
+            if cache_key is not None and len(stems_found) == len(self.STEMS):
+                try:
+                    self.cache.put(cache_key, {
+                        stem: os.path.join(job_output_dir, f"{stem}.wav")
+                        for stem in stems_found
+                    })
+                except OSError as e:
+                    print(f"Stem cache error: {e}")
             
             # Clean up input file
             if os.path.exists(input_path):
                 os.remove(input_path)
             
-            self.jobs[job_id] = JobStatus(
+            self.set_status(
+                job_id,
                 status=JobStatusEnum.COMPLETED,
                 progress=1.0,
                 stems=stems_found
             )
             
-        except subprocess.TimeoutExpired:
-            self.jobs[job_id] = JobStatus(
-                status=JobStatusEnum.FAILED,
-                error="Processing timeout - file may be too large"
-            )
         except Exception as e:
-            self.jobs[job_id] = JobStatus(
+            self.set_status(
+                job_id,
                 status=JobStatusEnum.FAILED,
                 error=str(e)
             )
     
+    def _apply_models(
+        self, job_id: str, wav: torch.Tensor, dtype: Optional[torch.dtype]
+    ) -> torch.Tensor:
+        """
+        Run the model on a normalized mix, autocasting to dtype if given,
+        and return the weighted per-source estimates in FP32.
+        """
+        # Run a bag's sub-models one at a time (as apply_model does
+        # internally) so progress can be reported after each one
+        if isinstance(self.model, BagOfModels):
+            sub_models = list(zip(self.model.models, self.model.weights))
+        else:
+            sub_models = [(self.model, [1.0] * len(self.model.sources))]
+        
+        sources = 0
+        totals = [0.0] * len(self.model.sources)
+        with torch.no_grad(), torch.autocast(
+            device_type=self.device,
+            dtype=dtype,
+            enabled=dtype is not None
+        ):
+            for i, (sub_model, weights) in enumerate(sub_models):
+                out = apply_model(
+                    sub_model,
+                    wav[None],
+                    device=self.device,
+                    split=True,
+                    overlap=0.25,
+                    progress=False,
+                    segment=self.segment
+                )[0].float()
+                for k, weight in enumerate(weights):
+                    out[k] *= weight
+                    totals[k] += weight
+                sources = sources + out
+                del out
+                
+                self.update_job(job_id, progress=0.2 + 0.7 * (i + 1) / len(sub_models))
+        
+        for k, total in enumerate(totals):
+            sources[k] /= total
+        return sources
+    
+    def _cache_lookup_key(self, input_path: str) -> Optional[str]:
+        """
+        Key for the stem cache: the audio's hash plus every setting that
+        changes the separated output. Returns None if hashing fails.
+        """
+        try:
+            audio_hash = self.cache.hash_file(input_path)
+        except OSError as e:
+            print(f"Stem cache error: {e}")
+            return None
+        
+        settings = f"{self.MODEL}|segment={self.segment}|dtype={self.autocast_dtype}"
+        return hashlib.sha256(f"{audio_hash}|{settings}".encode()).hexdigest()
+    
+    def _serve_from_cache(self, job_id: str, input_path: str, cache_key: str) -> bool:
+        """
+        Complete a job from cached stems if present, skipping Demucs.
+        Returns False on a miss so the caller runs the model.
+        """
+        job_output_dir = os.path.join(self.output_dir, job_id)
+        if not self._link_cached_stems(cache_key, job_output_dir):
+            return False
+        
+        if os.path.exists(input_path):
+            os.remove(input_path)
+        
+        self.set_status(
+            job_id,
+            status=JobStatusEnum.COMPLETED,
+            progress=1.0,
+            stems=list(self.STEMS)
+        )
+        return True
+    
+    def _link_cached_stems(self, cache_key: str, job_output_dir: str) -> bool:
+        """
+        Link cached stems into job_output_dir. Returns False on a miss or
+        if the entry is evicted mid-link, so the caller runs the model.
+        """
+        try:
+            cached_stems = self.cache.get(cache_key)
+            if not cached_stems:
+                return False
+            os.makedirs(job_output_dir, exist_ok=True)
+            for stem, src in cached_stems.items():
+                link_or_copy(src, os.path.join(job_output_dir, f"{stem}.wav"))
+            return True
+        except OSError as e:
+            print(f"Stem cache error: {e}")
+            return False
+    
+    def _run_model(self, job_id: str, input_path: str, job_output_dir: str) -> List[str]:
+        """
+        Separate input_path with the resident model and write each stem
+        to job_output_dir/<stem>.wav. Mirrors demucs.separate's pipeline.
+        """
+        wav = AudioFile(input_path).read(
+            streams=0,
+            samplerate=self.model.samplerate,
+            channels=self.model.audio_channels
+        )
+        ref = wav.mean(0)
+        wav = (wav - ref.mean()) / ref.std()
+        
+        sources = self._apply_models(job_id, wav, self.autocast_dtype)
+        if self.autocast_dtype is not None and not torch.isfinite(sources).all():
+            # Half precision overflowed; redo the separation in FP32
+            print(f"Non-finite output under {self.autocast_dtype} for job {job_id}; retrying in FP32")
+            sources = self._apply_models(job_id, wav, None)
+        if not torch.isfinite(sources).all():
+            raise ValueError("Separation produced non-finite audio")
+        
+        sources = sources * ref.std() + ref.mean()
+        
+        stems_found = [stem for stem in self.STEMS if stem in self.model.sources]
+        futures = [
+            self._write_pool.submit(
+                save_audio,
+                sources[self.model.sources.index(stem)].cpu(),
+                os.path.join(job_output_dir, f"{stem}.wav"),
+                samplerate=self.model.samplerate
+            )
+            for stem in stems_found
+        ]
+        for future in futures:
+            future.result()
+        
+        return stems_found
+    
     def cancel_job(self, job_id: str) -> bool:
         """Cancel a job and clean up its files."""
-        if job_id not in self.jobs:
+        if not self.update_job(job_id, status=JobStatusEnum.CANCELLED):
             return False
         
-        self.jobs[job_id].status = JobStatusEnum.CANCELLED
-        
         # Clean up output directory
         job_output_dir = os.path.join(self.output_dir, job_id)
         if os.path.exists(job_output_dir):
             shutil.rmtree(job_output_dir)
         
         return True
-
-
-# TODO: Future caching implementation
-# 
-# class StemCache:
-#     """
-#     Cache for separated stems to avoid re-processing the same audio.
-#     
-#     Implementation notes:
-#     - Key stems by SHA-256 hash of source audio file
-#     - Store stems in a dedicated cache directory
-#     - Implement LRU eviction when cache exceeds size limit
-#     - Consider using Redis for distributed caching in production
-#     
-#     Usage:
-#         cache = StemCache(cache_dir="/path/to/cache", max_size_gb=10)
-#         
-#         # Check cache before processing
-#         audio_hash = cache.hash_file(input_path)
-#         cached_stems = cache.get(audio_hash)
-#         
-#         if cached_stems:
-#             return cached_stems
-#         
-#         # Process and cache
-#         stems = demucs_service.separate(input_path)
-#         cache.put(audio_hash, stems)
-#     """
-#     pass